@@ -1,8 +1,18 @@
-from playwright.sync_api import sync_playwright
-from bs4 import BeautifulSoup
-import time
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from selectolax.lexbor import LexborHTMLParser
+import aiofiles
+import asyncio
 import os
 
+# Количество одновременно обрабатываемых страниц
+CONCURRENCY = 12
+
+# Формулы готовы, когда KaTeX на странице нет или он уже вставил аннотации
+KATEX_READY_JS = (
+    "() => !document.querySelector('.katex')"
+    " || document.querySelectorAll('.katex-mathml annotation').length > 0"
+)
+
 # Чтение URL из файла и формирование списка
 with open("urls.txt", "r", encoding="utf-8") as f:
     urls = [line.strip() for line in f if line.strip()]
@@ -10,54 +20,101 @@ with open("urls.txt", "r", encoding="utf-8") as f:
 # Создаём папку для файлов
 os.makedirs("pages_texts", exist_ok=True)
 
-def katex_to_latex(soup):
+def katex_to_latex(tree):
     """
-    Преобразует KaTeX/MathML формулы в текст LaTeX, чтобы они попали в get_text()
+    Преобразует KaTeX/MathML формулы в текст LaTeX, чтобы они попали в text(),
+    и заменяет изображения на [IMAGE] — за один CSS-проход по дереву
     """
-    # KaTeX с MathML (новые версии)
-    for mathml_span in soup.select("span.katex-mathml"):
-        annotation = mathml_span.select_one("annotation[encoding='application/x-tex']")
-        if annotation and annotation.string:
-            latex = annotation.string.strip()
-            mathml_span.string = f"${latex}$"
-
-    # KaTeX с data-tex (иногда встречается)
-    for katex_span in soup.select("span.katex"):
-        if katex_span.get("data-tex"):
-            latex = katex_span["data-tex"].strip()
-            katex_span.string = f"${latex}$"
-
-def get_page_text(url):
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(url)
-        # Ждем рендеринга KaTeX/MathJax
-        time.sleep(2)
-        html = page.content()
-        browser.close()
-
-    soup = BeautifulSoup(html, "html.parser")
-
-    # Преобразуем формулы KaTeX/MathML в LaTeX
-    katex_to_latex(soup)
-
-    # Изображения → [IMAGE]
-    for img in soup.find_all("img"):
-        img.replace_with("[IMAGE]")
+    # Идем с конца документа: вложенные узлы заменяются раньше родителей,
+    # поэтому katex-mathml обрабатывается до внешнего span.katex, как и раньше
+    for node in reversed(tree.css("span.katex-mathml, span.katex, img")):
+        if node.tag == "img":
+            node.replace_with("[IMAGE]")
+            continue
+
+        classes = (node.attributes.get("class") or "").split()
+        if "katex-mathml" in classes:
+            # KaTeX с MathML (новые версии)
+            annotation = node.css_first('annotation[encoding="application/x-tex"]')
+            latex = annotation.text().strip() if annotation else ""
+            if latex:
+                node.replace_with(f"${latex}$")
+        elif node.attributes.get("data-tex"):
+            # KaTeX с data-tex (иногда встречается)
+            latex = node.attributes["data-tex"].strip()
+            node.replace_with(f"${latex}$")
+
+async def get_page_text(url, browser):
+    context = await browser.new_context()
+    try:
+        page = await context.new_page()
+        await page.goto(url, wait_until="domcontentloaded")
+        # Ждем рендеринга KaTeX ровно столько, сколько нужно
+        try:
+            await page.wait_for_function(KATEX_READY_JS, timeout=5000)
+        except PlaywrightTimeoutError:
+            pass  # Формулы не успели отрендериться, берем что есть
+        # Страницы без формул дожидаемся по затиханию сети
+        if not await page.query_selector(".katex"):
+            try:
+                await page.wait_for_load_state("networkidle", timeout=5000)
+            except PlaywrightTimeoutError:
+                pass
+        html = await page.content()
+    finally:
+        await context.close()
+
+    tree = LexborHTMLParser(html)
+
+    # Формулы KaTeX/MathML → LaTeX, изображения → [IMAGE]
+    katex_to_latex(tree)
 
     # Получаем текст страницы
-    page_text = soup.get_text(separator="\n")
+    page_text = tree.body.text(separator="\n") if tree.body else ""
     return page_text
 
-# Обработка всех страниц
-for i, url in enumerate(urls, 1):
-    print(f"Обработка страницы {i}/{len(urls)}: {url}")
-    text = get_page_text(url)
-
+async def write_page(i, text):
     # Создаем файл с порядковым номером
     filename = f"pages_texts/page_{i}.txt"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(text)
+    async with aiofiles.open(filename, "w", encoding="utf-8") as f:
+        await f.write(text)
+
+async def writer(queue):
+    """Единственная задача записи: сбрасывает страницы на диск, пока воркеры качают следующие"""
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            await write_page(*item)
+        finally:
+            queue.task_done()
+
+async def main():
+    # Ограничиваем число одновременно открытых страниц
+    sem = asyncio.Semaphore(CONCURRENCY)
+    queue = asyncio.Queue()
+    writer_task = asyncio.create_task(writer(queue))
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+
+        async def worker(i, url):
+            async with sem:
+                print(f"Обработка страницы {i}/{len(urls)}: {url}")
+                text = await get_page_text(url, browser)
+            # Отдаем страницу на запись и сразу освобождаем воркер
+            await queue.put((i, text))
+
+        try:
+            await asyncio.gather(*[worker(i, url) for i, url in enumerate(urls, 1)])
+        finally:
+            await browser.close()
+            # Дожидаемся, пока все страницы будут записаны
+            await queue.put(None)
+            await writer_task
+
+    print("Готово! Каждая страница сохранена отдельно в папке pages_texts")
 
-print("Готово! Каждая страница сохранена отдельно в папке pages_texts")
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,12 +1,17 @@
 import streamlit as st
 import json
+import orjson
 import os
 import uuid
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import chromadb
 from chromadb import EmbeddingFunction, Documents, Embeddings
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # --- Загрузка API ключа ---
 load_dotenv()
@@ -15,36 +20,100 @@ genai.configure(api_key=os.getenv("GEMENI_API_KEY"))
 # --- Настройки ChromaDB ---
 CHROMA_PATH = "./chroma_db"
 COLLECTION_NAME = "tag_docs"
+CHROMA_BATCH_SIZE = 200  # Размер пачки для массовых операций с ChromaDB
 
 # --- Функция эмбендинга ---
+EMBED_MODEL = 'models/embedding-001'
+EMBED_TITLE = "tags"
+EMBED_BATCH_SIZE = 100  # Максимум документов в одном запросе к Gemini
+EMBED_CONCURRENCY = 8  # Одновременных запросов к Gemini, держим ниже rate limit
+
+@retry(
+    retry=retry_if_exception_type((
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    )),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+def _embed_chunk(chunk):
+    """Один запрос к Gemini на пачку документов, с повтором при временных ошибках"""
+    return genai.embed_content(
+        model=EMBED_MODEL,
+        content=chunk,
+        task_type="retrieval_document",
+        title=EMBED_TITLE
+    )["embedding"]
+
+@st.cache_resource
+def _embed_pool():
+    """Общий пул потоков для запросов к Gemini, переживает перезапуски скрипта"""
+    return ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="gemini-embed")
+
 class GeminiEmbeddingFunction(EmbeddingFunction):
     def __call__(self, input: Documents) -> Embeddings:
-        model = 'models/embedding-001'
-        title = "tags"
-        return genai.embed_content(
-            model=model,
-            content=input,
-            task_type="retrieval_document",
-            title=title
-        )["embedding"]
+        # Режем вход на пачки по лимиту Gemini: O(N/100) запросов вместо O(N)
+        chunks = [input[i:i + EMBED_BATCH_SIZE] for i in range(0, len(input), EMBED_BATCH_SIZE)]
+        if len(chunks) <= 1:
+            return [e for c in chunks for e in _embed_chunk(c)]
+        # Пачки уходят параллельно; результаты собираем в порядке отправки,
+        # поэтому эмбеддинги совпадают по порядку со входом
+        futs = [_embed_pool().submit(_embed_chunk, c) for c in chunks]
+        return [e for f in futs for e in f.result()]
 
 # --- Работа с ChromaDB ---
+@st.cache_resource
+def _chroma_client():
+    """Один клиент ChromaDB на весь процесс, а не на каждый перезапуск скрипта"""
+    return chromadb.PersistentClient(path=CHROMA_PATH)
+
+@st.cache_resource
 def get_chroma_db():
-    chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
+    chroma_client = _chroma_client()
     return chroma_client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=GeminiEmbeddingFunction())
 
+@st.cache_data(ttl=5)
+def chroma_snapshot():
+    """Один снимок документов ChromaDB на перезапуск вместо отдельного get() в каждом блоке.
+    После любой записи в ChromaDB кэш нужно сбросить через chroma_snapshot.clear()"""
+    db = get_chroma_db()
+    return db.get(include=['documents'])
+
 # --- Форматирование строки для эмбендинга ---
+TAG_PREFIX = "Tag: "
+TAG_PREFIX_LEN = len(TAG_PREFIX)
+
 def format_entry(tag_dict):
-    return f"""Tag: {tag_dict['tag']}
+    return f"""{TAG_PREFIX}{tag_dict['tag']}
 Description: {tag_dict['description']}
 Instruction: {tag_dict.get('merge_instruction', '')}
 Category: {tag_dict.get('category', '')}
 """
 
+def parse_tag_name(doc):
+    """Достает имя тега из первой строки документа, не разбивая весь документ"""
+    if not doc or not doc.startswith(TAG_PREFIX):
+        return None
+    nl = doc.find("\n", TAG_PREFIX_LEN)
+    return doc[TAG_PREFIX_LEN:nl].strip() if nl >= 0 else doc[TAG_PREFIX_LEN:].strip()
+
 # --- Управление синхронизацией с ChromaDB ---
 def get_tag_id(tag_name):
     """Генерирует стабильный ID для тега на основе его имени"""
-    return f"tag_{hash(tag_name) % (10**8)}"
+    # Встроенный hash() рандомизируется между процессами (PYTHONHASHSEED)
+    digest = hashlib.blake2b(tag_name.encode("utf-8"), digest_size=8).hexdigest()
+    return f"tag_{digest}"
+
+def is_legacy_tag_id(tag_id):
+    """ID старого формата: tag_<hash() % 10**8>"""
+    return tag_id.startswith("tag_") and tag_id[4:].isdigit()
+
+def content_hash(doc_str):
+    """Хеш текста документа — по нему Sync All пропускает неизменившиеся теги"""
+    return hashlib.blake2b(doc_str.encode("utf-8"), digest_size=16).hexdigest()
 
 def sync_tag_to_chroma(tag_data, db):
     """Добавляет или обновляет тег в ChromaDB"""
@@ -52,24 +121,91 @@ def sync_tag_to_chroma(tag_data, db):
     doc_str = format_entry(tag_data)
     
     try:
-        # Проверяем, существует ли уже этот тег
-        existing = db.get(ids=[tag_id])
-        if existing['ids']:
-            # Обновляем существующий
-            db.update(ids=[tag_id], documents=[doc_str])
-            return f"Updated tag '{tag_data['tag']}' in ChromaDB"
-        else:
-            # Добавляем новый
-            db.add(documents=[doc_str], ids=[tag_id])
-            return f"Added tag '{tag_data['tag']}' to ChromaDB"
+        # upsert сам решает, добавить запись или обновить существующую
+        db.upsert(ids=[tag_id], documents=[doc_str], metadatas=[{"hash": content_hash(doc_str)}])
+        chroma_snapshot.clear()
+        return f"Upserted tag '{tag_data['tag']}'"
     except Exception as e:
         return f"Error syncing tag '{tag_data['tag']}': {str(e)}"
 
+def _chunks(seq, n=CHROMA_BATCH_SIZE):
+    """Разбивает последовательность на пачки по n элементов"""
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def get_in_chunks(db, ids, include):
+    """db.get по пачкам: на десятках тысяч ID один запрос упирается
+    в лимит SQLite "too many SQL variables". Склеивает ответы в один словарь"""
+    result = {"ids": [], **{key: [] for key in include}}
+    for ids_chunk in _chunks(list(ids)):
+        part = db.get(ids=ids_chunk, include=include)
+        result["ids"].extend(part["ids"])
+        for key in include:
+            result[key].extend(part[key])
+    return result
+
+def sync_all_tags(tags_data, db, on_progress=None):
+    """Синхронизирует все теги с ChromaDB пачками вместо поштучных вызовов"""
+    # Одинаковые ID в одной пачке ChromaDB не принимает — оставляем последний
+    entries = {get_tag_id(t['tag']): format_entry(t) for t in tags_data}
+    ids = list(entries)
+    docs = list(entries.values())
+    if not ids:
+        return "No tags to sync"
+
+    # Хеши уже записанных документов; записи без метаданных считаем изменившимися
+    existing = get_in_chunks(db, ids, include=['metadatas'])
+    stored = {i: (m or {}).get("hash") for i, m in zip(existing['ids'], existing['metadatas'])}
+
+    to_add, to_update = [], []
+    for tag_id, doc in zip(ids, docs):
+        h = content_hash(doc)
+        if tag_id not in stored:
+            to_add.append((tag_id, doc, h))
+        elif stored[tag_id] != h:
+            to_update.append((tag_id, doc, h))
+    changed = to_add + to_update
+    unchanged = len(ids) - len(changed)
+
+    # Эмбеддинги считаем только для новых и изменившихся тегов и сразу для всех:
+    # ChromaDB вызывает функцию эмбеддинга на каждый upsert, и при пачках
+    # по CHROMA_BATCH_SIZE пул Gemini был бы занят не больше чем на 2 потока
+    embeddings = GeminiEmbeddingFunction()([d for _, d, _ in changed]) if changed else []
+
+    done = 0
+    for chunk, emb_chunk in zip(_chunks(changed), _chunks(embeddings)):
+        db.upsert(
+            ids=[i for i, _, _ in chunk],
+            documents=[d for _, d, _ in chunk],
+            embeddings=emb_chunk,
+            metadatas=[{"hash": h} for _, _, h in chunk],
+        )
+        done += len(chunk)
+        if on_progress:
+            on_progress(done / len(changed))
+    if changed:
+        chroma_snapshot.clear()
+    elif on_progress:
+        on_progress(1.0)
+    return f"Added {len(to_add)}, updated {len(to_update)} and skipped {unchanged} unchanged tags in ChromaDB"
+
+def delete_in_chunks(db, ids, on_progress=None):
+    """Удаляет записи пачками, чтобы каждая транзакция ChromaDB оставалась небольшой"""
+    ids = list(ids)
+    done = 0
+    for ids_chunk in _chunks(ids):
+        db.delete(ids=ids_chunk)
+        done += len(ids_chunk)
+        if on_progress:
+            on_progress(done / len(ids))
+    chroma_snapshot.clear()
+
 def remove_tag_from_chroma(tag_name, db):
     """Удаляет тег из ChromaDB"""
     tag_id = get_tag_id(tag_name)
     try:
         db.delete(ids=[tag_id])
+        chroma_snapshot.clear()
         return f"Removed tag '{tag_name}' from ChromaDB"
     except Exception as e:
         return f"Error removing tag '{tag_name}': {str(e)}"
@@ -78,7 +214,7 @@ def get_chroma_status():
     """Получает информацию о том, какие теги есть в ChromaDB"""
     try:
         db = get_chroma_db()
-        all_items = db.get()
+        all_items = db.get(include=[])
         chroma_ids = set(all_items['ids'])
         return chroma_ids, db
     except Exception as e:
@@ -87,26 +223,52 @@ def get_chroma_status():
 
 def check_sync_status(tags_data, chroma_ids):
     """Проверяет статус синхронизации тегов с ChromaDB"""
-    sync_status = {}
-    for tag in tags_data:
-        tag_id = get_tag_id(tag['tag'])
-        sync_status[tag['tag']] = tag_id in chroma_ids
-    return sync_status
+    names = [tag['tag'] for tag in tags_data]
+    ids = [get_tag_id(name) for name in names]
+    return dict(zip(names, (tag_id in chroma_ids for tag_id in ids)))
 
 # --- Работа с JSON ---
 JSON_PATH = "tag_docs.json"
 
-def load_tags():
+def get_tags_mtime():
+    """Время изменения JSON — ключ кэша для всех данных, зависящих от тегов"""
+    return os.path.getmtime(JSON_PATH) if os.path.exists(JSON_PATH) else 0.0
+
+@st.cache_data
+def load_tags_cached(mtime: float):
+    """Читает JSON заново только когда меняется время изменения файла.
+    Возвращает словарь {имя тега: запись}"""
     if os.path.exists(JSON_PATH):
         with open(JSON_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
-
-def save_tags(data):
-    with open(JSON_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-tags_data = load_tags()
+            return {tag["tag"]: tag for tag in json.load(f)}
+    return {}
+
+def save_tags(tags_by_name):
+    """Сохраняет словарь тегов в JSON списком записей"""
+    payload = orjson.dumps(
+        list(tags_by_name.values()),
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+    )
+    # Пишем во временный файл и атомарно подменяем, чтобы сбой
+    # посреди записи не испортил каталог
+    tmp_path = JSON_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, JSON_PATH)
+    load_tags_cached.clear()
+
+@st.cache_data
+def compute_categories(mtime: float):
+    """Отсортированный список категорий, пересчитывается только при изменении JSON"""
+    return sorted({t["category"] for t in load_tags_cached(mtime).values() if t.get("category")})
+
+@st.cache_data
+def tag_index(mtime: float):
+    """Пары (имя тега, имя в нижнем регистре) — строятся один раз на версию JSON"""
+    return [(name, name.lower()) for name in load_tags_cached(mtime)]
+
+tags_mtime = get_tags_mtime()
+tags_by_name = load_tags_cached(tags_mtime)
 
 # --- Интерфейс Streamlit ---
 st.set_page_config(page_title="Tag Documentation", layout="wide")
@@ -114,7 +276,7 @@ st.title("🧷 Tag Documentation Editor")
 
 # --- Получаем статус ChromaDB ---
 chroma_ids, db = get_chroma_status()
-sync_status = check_sync_status(tags_data, chroma_ids) if db else {}
+sync_status = check_sync_status(tags_by_name.values(), chroma_ids) if db else {}
 
 # --- Колонки для основного интерфейса ---
 col1, col2 = st.columns([2, 1])
@@ -122,8 +284,8 @@ col1, col2 = st.columns([2, 1])
 with col1:
     # --- Поиск и выбор ---
     search_query = st.text_input("Search", "")
-    filtered_tags = [tag for tag in tags_data if search_query.lower() in tag["tag"].lower()]
-    existing_tag_names = [t["tag"] for t in filtered_tags]
+    query = search_query.lower()
+    existing_tag_names = [name for name, lc in tag_index(tags_mtime) if query in lc]
 
     selected_tag = st.selectbox("Choose existing tag to edit", [""] + existing_tag_names)
     new_tag_input = st.text_input("Or enter a new tag to create", "")
@@ -134,7 +296,7 @@ with col1:
         tag_data = {"tag": current_tag, "description": "", "merge_instruction": "", "category": ""}
     elif selected_tag:
         current_tag = selected_tag
-        tag_data = next((t for t in tags_data if t["tag"] == selected_tag), {"tag": "", "description": "", "merge_instruction": "", "category": ""})
+        tag_data = tags_by_name.get(selected_tag, {"tag": "", "description": "", "merge_instruction": "", "category": ""})
     else:
         current_tag = ""
         tag_data = {"tag": "", "description": "", "merge_instruction": "", "category": ""}
@@ -165,9 +327,8 @@ with col1:
             }
 
             # Обновляем JSON
-            tags_data = [t for t in tags_data if t["tag"] != current_tag]
-            tags_data.append(new_entry)
-            save_tags(tags_data)
+            tags_by_name[current_tag] = new_entry
+            save_tags(dict(sorted(tags_by_name.items())))
 
             # Обновляем ChromaDB
             if db:
@@ -184,8 +345,8 @@ with col1:
         # Обработка удаления
         if delete_clicked and current_tag and selected_tag:
             # Удаляем из JSON
-            tags_data = [t for t in tags_data if t["tag"] != current_tag]
-            save_tags(tags_data)
+            tags_by_name.pop(current_tag, None)
+            save_tags(dict(sorted(tags_by_name.items())))
             
             # Удаляем из ChromaDB
             if db:
@@ -216,15 +377,12 @@ with col2:
             # Кнопка полной синхронизации
             if st.button("🔄 Sync All Tags"):
                 progress_bar = st.progress(0)
-                for i, tag in enumerate(tags_data):
-                    try:
-                        sync_tag_to_chroma(tag, db)
-                        progress_bar.progress((i + 1) / len(tags_data))
-                        time.sleep(0.1)  # Небольшая задержка
-                    except Exception as e:
-                        st.error(f"Failed to sync {tag['tag']}: {e}")
-                st.success("✅ All tags synced!")
-                st.rerun()
+                try:
+                    result = sync_all_tags(tags_by_name.values(), db, on_progress=progress_bar.progress)
+                    st.success(f"✅ {result}")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"❌ Failed to sync tags with ChromaDB: {e}")
             
             # Подробный статус
             if st.checkbox("Show detailed sync status"):
@@ -234,13 +392,13 @@ with col2:
 
 # --- Сайдбар с категориями и статистикой ---
 st.sidebar.markdown("### 📊 Statistics")
-st.sidebar.write(f"**Total tags in JSON:** {len(tags_data)}")
+st.sidebar.write(f"**Total tags in JSON:** {len(tags_by_name)}")
 if db:
     st.sidebar.write(f"**Records in ChromaDB:** {len(chroma_ids)}")
     st.sidebar.info("💡 Note: ChromaDB may have more records than tags if there are duplicates or old entries")
 
 st.sidebar.markdown("### 📚 Existing Categories")
-categories = sorted(set(tag["category"] for tag in tags_data if tag.get("category")))
+categories = compute_categories(tags_mtime)
 for cat in categories:
     st.sidebar.write(f"- {cat}")
 
@@ -249,7 +407,7 @@ if st.sidebar.checkbox("📋 Show ChromaDB Analysis"):
     if db:
         try:
             # Получаем все документы для анализа
-            all_data = db.get(include=['documents'])
+            all_data = chroma_snapshot()
             
             if all_data and all_data['documents']:
                 st.sidebar.markdown("#### 🔍 Document Analysis")
@@ -258,11 +416,10 @@ if st.sidebar.checkbox("📋 Show ChromaDB Analysis"):
                 tag_docs = []
                 other_docs = []
                 
-                for i, doc in enumerate(all_data['documents']):
-                    if doc.startswith("Tag: "):
-                        # Извлекаем имя тега из документа
-                        lines = doc.split('\n')
-                        tag_name = lines[0].replace("Tag: ", "").strip()
+                for doc in all_data['documents']:
+                    # Извлекаем имя тега из документа
+                    tag_name = parse_tag_name(doc)
+                    if tag_name is not None:
                         tag_docs.append(tag_name)
                     else:
                         other_docs.append(doc[:50] + "..." if len(doc) > 50 else doc)
@@ -298,23 +455,21 @@ if st.sidebar.checkbox("📋 Show ChromaDB Analysis"):
 def get_all_chroma_documents():
     """Получает все документы из ChromaDB с их содержимым"""
     try:
-        db = get_chroma_db()
-        all_data = db.get(include=['documents'])  # Исправлено: убрал 'ids' из include
-        return all_data
+        return chroma_snapshot()
     except Exception as e:
         st.error(f"Error getting ChromaDB documents: {e}")
         return None
 
-def clean_orphaned_chroma_entries(tags_data):
+def clean_orphaned_chroma_entries(tags_by_name):
     """Удаляет записи из ChromaDB, которых нет в JSON"""
     if not db:
         return "ChromaDB not available"
     
     # Получаем все ожидаемые ID из JSON
-    expected_ids = {get_tag_id(tag['tag']) for tag in tags_data}
+    expected_ids = {get_tag_id(name) for name in tags_by_name}
     
     # Получаем все ID из ChromaDB
-    all_data = db.get()
+    all_data = db.get(include=[])
     existing_ids = set(all_data['ids'])
     
     # Находим лишние записи
@@ -322,13 +477,42 @@ def clean_orphaned_chroma_entries(tags_data):
     
     if orphaned_ids:
         try:
-            db.delete(ids=list(orphaned_ids))
-            return f"Removed {len(orphaned_ids)} orphaned entries from ChromaDB"
+            migrated = migrate_legacy_chroma_entries(orphaned_ids, tags_by_name, existing_ids)
+            delete_in_chunks(db, orphaned_ids)
+            result = f"Removed {len(orphaned_ids)} orphaned entries from ChromaDB"
+            if migrated:
+                result += f" (re-added {migrated} tags under stable IDs)"
+            return result
         except Exception as e:
             return f"Error removing orphaned entries: {e}"
     else:
         return "No orphaned entries found"
 
+def migrate_legacy_chroma_entries(orphaned_ids, tags_by_name, existing_ids):
+    """Переносит записи со старыми ID (на основе hash()) на стабильные ID"""
+    legacy_ids = [i for i in orphaned_ids if is_legacy_tag_id(i)]
+    if not legacy_ids:
+        return 0
+
+    legacy_docs = get_in_chunks(db, legacy_ids, include=['documents'])
+
+    to_migrate = {}
+    for doc in legacy_docs['documents']:
+        tag_name = parse_tag_name(doc)
+        tag = tags_by_name.get(tag_name)
+        if tag and get_tag_id(tag_name) not in existing_ids:
+            to_migrate[get_tag_id(tag_name)] = format_entry(tag)
+
+    ids = list(to_migrate)
+    for ids_chunk in _chunks(ids):
+        docs_chunk = [to_migrate[i] for i in ids_chunk]
+        db.upsert(
+            ids=ids_chunk,
+            documents=docs_chunk,
+            metadatas=[{"hash": content_hash(d)} for d in docs_chunk],
+        )
+    return len(to_migrate)
+
 def search_tag_in_chroma(tag_name):
     """Ищет тег в ChromaDB по содержимому документа"""
     try:
@@ -336,13 +520,15 @@ def search_tag_in_chroma(tag_name):
         if not all_data:
             return []
         
+        query = tag_name.lower()
+        exact = f"{TAG_PREFIX}{tag_name}"
         matches = []
         for i, doc in enumerate(all_data['documents']):
-            if tag_name.lower() in doc.lower():
+            if doc.lower().find(query) >= 0:
                 matches.append({
                     'id': all_data['ids'][i],
                     'document': doc,
-                    'exact_match': f"Tag: {tag_name}" in doc
+                    'exact_match': doc.find(exact) >= 0
                 })
         return matches
     except Exception as e:
@@ -386,7 +572,7 @@ if st.sidebar.button("🔍 Show All ChromaDB Entries"):
                 'document': doc[:100] + "..." if len(doc) > 100 else doc
             }
             
-            if doc.startswith("Tag: "):
+            if doc.startswith(TAG_PREFIX):
                 tag_entries.append(entry)
             else:
                 other_entries.append(entry)
@@ -402,7 +588,7 @@ if st.sidebar.button("🔍 Show All ChromaDB Entries"):
             st.sidebar.write(f"**Other entries: {len(other_entries)}**")
 
 if st.sidebar.button("🧹 Clean Orphaned Entries"):
-    result = clean_orphaned_chroma_entries(tags_data)
+    result = clean_orphaned_chroma_entries(tags_by_name)
     st.sidebar.success(result)
     st.rerun()
 
@@ -412,12 +598,15 @@ if st.sidebar.button("⚠️ Clear All ChromaDB", type="secondary"):
     if st.sidebar.checkbox("I confirm clearing ALL ChromaDB data"):
         try:
             # Получаем все ID из ChromaDB
-            all_data = db.get()
+            all_data = db.get(include=[])
             if all_data['ids']:
-                db.delete(ids=all_data['ids'])
+                delete_in_chunks(db, all_data['ids'], on_progress=st.sidebar.progress(0).progress)
                 st.sidebar.success(f"✅ Deleted {len(all_data['ids'])} records from ChromaDB")
             else:
                 st.sidebar.info("ChromaDB is already empty")
+            # Сбрасываем закэшированные клиент, коллекцию и снимок
+            st.cache_resource.clear()
+            chroma_snapshot.clear()
             st.rerun()
         except Exception as e:
             st.sidebar.error(f"Error clearing ChromaDB: {e}")